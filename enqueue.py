@@ -5,6 +5,8 @@
 import argparse
 import random
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 def main():
@@ -35,6 +37,12 @@ def main():
         default="http://localhost:8099",
         help="サーバーのベースURL（デフォルト: http://localhost:8099）"
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="1回の /enqueue_bulk で送るジョブ数（デフォルト: 1000）"
+    )
     parser.add_argument(
         "--randomize",
         action="store_true",
@@ -55,8 +63,13 @@ def main():
         print(f"Error: digits must be positive, got {args.digits}", file=sys.stderr)
         sys.exit(1)
     
+    if args.batch_size <= 0:
+        print(f"Error: batch-size must be positive, got {args.batch_size}", file=sys.stderr)
+        sys.exit(1)
+    
     base_url = args.base.rstrip("/")
     enqueue_url = f"{base_url}/enqueue"
+    enqueue_bulk_url = f"{base_url}/enqueue_bulk"
     
     session = requests.Session()
     success_count = 0
@@ -70,22 +83,43 @@ def main():
     else:
         print(f"Enqueueing {args.count} jobs (start={args.start}, digits={args.digits})...")
     
-    for job_num, i in enumerate(job_indices, 1):
-        start_pos = args.start + i*args.digits
-        payload = {
-            "type": "bbp_hex",
-            "start": start_pos,
-            "count": args.digits
-        }
-        
+    payloads = [
+        {"type": "bbp_hex", "start": args.start + i*args.digits, "count": args.digits}
+        for i in job_indices
+    ]
+    
+    local = threading.local()
+
+    def post_one(payload):
+        # /enqueue_bulk が無いサーバー向けのフォールバック（1件ずつ並列にPOST）
+        # Session はスレッドセーフではないので、スレッドごとに持つ
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        try:
+            response = local.session.post(enqueue_url, json=payload, timeout=10)
+            response.raise_for_status()
+            return True
+        except requests.exceptions.RequestException as e:
+            print(f"  ✗ Job start={payload['start']}, count={payload['count']} - Error: {e}", file=sys.stderr)
+            return False
+    
+    # まとめて POST（バッチごとに1往復）
+    for offset in range(0, len(payloads), args.batch_size):
+        batch = payloads[offset:offset + args.batch_size]
         try:
-            response = session.post(enqueue_url, json=payload, timeout=10)
+            response = session.post(enqueue_bulk_url, json=batch, timeout=30)
+            if response.status_code == 404:
+                with ThreadPoolExecutor(max_workers=32) as ex:
+                    ok = list(ex.map(post_one, batch))
+                success_count += sum(ok)
+                fail_count += len(ok) - sum(ok)
+                continue
             response.raise_for_status()
-            success_count += 1
-            print(f"  ✓ Job {job_num}/{args.count}: start={start_pos}, count={args.digits}")
+            success_count += len(batch)
+            print(f"  ✓ Jobs {offset + 1}-{offset + len(batch)}/{args.count}")
         except requests.exceptions.RequestException as e:
-            fail_count += 1
-            print(f"  ✗ Job {job_num}/{args.count}: start={start_pos}, count={args.digits} - Error: {e}", file=sys.stderr)
+            fail_count += len(batch)
+            print(f"  ✗ Jobs {offset + 1}-{offset + len(batch)}/{args.count} - Error: {e}", file=sys.stderr)
     
     print(f"\nCompleted: {success_count} succeeded, {fail_count} failed")
     
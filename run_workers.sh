@@ -71,7 +71,8 @@ start_workers() {
     
     # 各ワーカーを起動
     for i in $(seq 1 "$NUM_WORKERS"); do
-        python3 worker.py > "${LOG_DIR}/worker_${i}.log" 2>&1 &
+        # プロセス数はこのスクリプトで管理するので、各 worker.py は1プロセスで動かす
+        python3 worker.py --procs 1 > "${LOG_DIR}/worker_${i}.log" 2>&1 &
         local pid=$!
         write_pids "$pid"
         echo "  Worker $i started (PID: $pid)"
@@ -1,52 +1,111 @@
-import os, time, json, uuid, asyncio
-from typing import Optional, Any, Dict, Set
+import os, time, asyncio
+from typing import Optional, Any, Awaitable, Callable, Dict, List, Set, Tuple
 from collections import deque
 
 from fastapi import FastAPI, HTTPException, Body, WebSocket, WebSocketDisconnect, status
-from fastapi.responses import Response, PlainTextResponse
+from fastapi.responses import Response, PlainTextResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 
-import redis
+import orjson
+from redis.asyncio import Redis
 
 REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
 ROOT_PATH = os.environ.get("ROOT_PATH", "/os")  # nginxのprefixに合わせる
 
-QUEUE_KEY = "pi:queue"          # List: job_id
+# job は {"job_id": ..., "payload": {...}} の JSON（以下 record）として保存する
+QUEUE_KEY = "pi:queue"          # List: record
 INFLIGHT_KEY = "pi:inflight"    # ZSET: score=deadline(unix sec), member=job_id
-PAYLOAD_KEY_PREFIX = "pi:payload:"  # String: JSON payload
+INFLIGHT_RECORD_KEY = "pi:inflight:record"  # Hash: job_id -> record
 RESULT_KEY_PREFIX = "pi:result:"    # String: JSON result
+JOB_SEQ_KEY = "pi:jobseq"       # String: job_id の採番カウンタ（clear でも戻さない）
+DEAD_LETTER_KEY = "pi:queue:dead"  # List: queue にあった形式違いの record（調査用に退避）
+VERSION_KEY = "pi:version"      # String: queue/inflight を変更するたびに INCR（差分の seq。clear でも戻さない）
 
 LEASE_SEC = 10
+MAX_JOBS_PER_REQUEST = 16  # /jobs で一度に取り出せる上限（最後の job の lease は LEASE_SEC * この値になる）
 REQUEUE_PERIOD_SEC = 1  # 回収ループの周期
+SEND_QUEUE_SIZE = 256  # WebSocket 接続ごとの送信キュー上限（溢れたら切断）
 
 
 
 # WebSocket connection manager
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Set[WebSocket] = set()
+        # websocket -> 送信キュー
+        self.active_connections: Dict[WebSocket, asyncio.Queue] = {}
+        # websocket -> 送信タスク
+        self.senders: Dict[WebSocket, asyncio.Task] = {}
+        self.closing: Set[asyncio.Task] = set()
         self.recent_results: deque = deque(maxlen=50)  # Keep last 50 results
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, initial_messages: Callable[[], Awaitable[List[dict]]]):
+        """
+        接続を登録し、initial_messages()（スナップショット）を最初に送る。
+        スナップショット作成中に配信された差分はその後ろに並べ直す。
+        スナップショットと差分には seq が付いているので、反映済みの差分はクライアントが読み飛ばす。
+        """
         await websocket.accept()
-        self.active_connections.add(websocket)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.active_connections[websocket] = queue
+        try:
+            messages = await initial_messages()
+        except Exception:
+            self.disconnect(websocket)
+            raise
+        if websocket not in self.active_connections:
+            return  # スナップショット作成中に溢れて切断された
+        pending = []
+        while not queue.empty():
+            pending.append(queue.get_nowait())
+        for data in [orjson.dumps(m).decode() for m in messages] + pending:
+            self._enqueue(websocket, queue, data)
+        if websocket in self.active_connections:
+            self.senders[websocket] = asyncio.create_task(self._sender(websocket, queue))
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.discard(websocket)
+        self.active_connections.pop(websocket, None)
+        task = self.senders.pop(websocket, None)
+        if task is not None:
+            task.cancel()
+
+    async def _sender(self, websocket: WebSocket, queue: asyncio.Queue):
+        """接続ごとの送信ループ。遅いクライアントは自分のキューだけを詰まらせる"""
+        try:
+            while True:
+                data = await queue.get()
+                await websocket.send_text(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 送信失敗 = 切断扱い
+            self.active_connections.pop(websocket, None)
+            self.senders.pop(websocket, None)
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)  # Try Again Later
+        except Exception:
+            pass
+
+    def _enqueue(self, websocket: WebSocket, queue: asyncio.Queue, data: str):
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # 差分配信なので1通でも捨てると状態がずれる。
+            # 追いつけないクライアントは切断し、再接続時のスナップショットで復帰させる。
+            self.disconnect(websocket)
+            task = asyncio.create_task(self._close(websocket))
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
 
     async def broadcast(self, message: dict):
         """Broadcast message to all connected clients"""
-        disconnected = set()
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception:
-                disconnected.add(connection)
-        # Remove disconnected connections
-        for connection in disconnected:
-            self.active_connections.discard(connection)
+        # 全クライアント共通なので JSON 化は1回だけ
+        data = orjson.dumps(message).decode()
+        for websocket, queue in list(self.active_connections.items()):
+            self._enqueue(websocket, queue, data)
 
     def add_result(self, job_id: str, result: dict):
         """Add result to recent results list"""
@@ -58,24 +117,145 @@ class ConnectionManager:
 
 manager = ConnectionManager()
 
+class QueueCounts:
+    """
+    queue / inflight の件数をプロセス内で保持する。
+    Redis を変更した箇所で増減させ、state 配信のたびに LLEN/ZCARD を叩かずに済ませる。
+    """
+    def __init__(self):
+        self.queue_length = 0
+        self.inflight_count = 0
+
+    async def sync(self):
+        """Redis の実件数で初期化"""
+        pipe = r.pipeline(transaction=False)
+        pipe.llen(QUEUE_KEY)
+        pipe.zcard(INFLIGHT_KEY)
+        self.queue_length, self.inflight_count = await pipe.execute()
+
+    def move(self, queue: int = 0, inflight: int = 0):
+        self.queue_length = max(0, self.queue_length + queue)
+        self.inflight_count = max(0, self.inflight_count + inflight)
+
+    def reset(self):
+        self.queue_length = 0
+        self.inflight_count = 0
+
+counts = QueueCounts()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # startup 相当
-    task = asyncio.create_task(requeue_loop())
+    await counts.sync()
+    tasks = [
+        asyncio.create_task(requeue_loop()),
+    ]
     try:
         yield
     finally:
         # shutdown 相当
-        task.cancel()
-        try:
-            await task
-        except asyncio.CancelledError:
-            pass
-
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await r.aclose()
+
+
+r = Redis.from_url(REDIS_URL, decode_responses=True)
+
+# 以下の変更系スクリプトは VERSION_KEY を INCR し、その値（seq）も返す。
+# 差分はハンドラごとに別の接続で実行されるので、配信順は Redis の実行順と入れ替わり得る。
+# クライアントは seq を見て古い差分を読み飛ばす。
+
+# payload(JSON) ごとに job_id を採番し、record としてキューに積む。{最後の job_id, seq} を返す。
+# payload は再エンコードせず文字列のまま埋め込む（cjson だと数値の精度が落ちるため）。
+# KEYS[1]=queue, KEYS[2]=jobseq, KEYS[3]=version, ARGV[i]=payload_json
+_enqueue_lua = r.register_script("""
+local last = redis.call('INCRBY', KEYS[2], #ARGV)
+local first = last - #ARGV
+for i, payload in ipairs(ARGV) do
+    local job_id = string.format('%d', first + i)
+    redis.call('LPUSH', KEYS[1], '{"job_id":"' .. job_id .. '","payload":' .. payload .. '}')
+end
+return {last, redis.call('INCR', KEYS[3])}
+""")
+
+# キューから最大 ARGV[2] 件取り出して in-flight に登録し、{捨てた件数, 取り出した record の一覧, seq} を返す。
+# 何も取り出せなければ seq は 0。
+# worker は受け取った順に1件ずつ処理するので、i 件目の期限は now + lease * i とする。
+# record の先頭は _enqueue_lua が組み立てた形で固定なので、payload は decode せず job_id だけ切り出す。
+# 形式の違う record（旧形式の job_id のみ等）は途中で止まらないよう dead letter に移して数える。
+# KEYS[1]=queue, KEYS[2]=inflight, KEYS[3]=inflight record, KEYS[4]=dead letter, KEYS[5]=version,
+# ARGV[1]=now, ARGV[2]=最大件数, ARGV[3]=lease(秒)
+_pop_jobs_lua = r.register_script("""
+local out = {}
+local dropped = 0
+for i = 1, tonumber(ARGV[2]) do
+    local record = redis.call('RPOP', KEYS[1])
+    if not record then break end
+    local job_id = string.match(record, '^{"job_id":"(%d+)"')
+    if job_id then
+        table.insert(out, record)
+        redis.call('ZADD', KEYS[2], tonumber(ARGV[1]) + tonumber(ARGV[3]) * #out, job_id)
+        redis.call('HSET', KEYS[3], job_id, record)
+    else
+        redis.call('LPUSH', KEYS[4], record)
+        dropped = dropped + 1
+    end
+end
+local seq = 0
+if #out > 0 then
+    seq = redis.call('INCR', KEYS[5])
+end
+return {dropped, out, seq}
+""")
+
+# 結果を保存して in-flight から削除し、{初回か(1/0), in-flightから消えた件数, seq} を返す。
+# 既に結果があれば保存はしない。in-flight から消えなければ seq は 0。
+# KEYS[1]=result, KEYS[2]=inflight, KEYS[3]=inflight record, KEYS[4]=version,
+# ARGV[1]=result_json, ARGV[2]=job_id
+_post_result_lua = r.register_script("""
+local was_new = 0
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[1], ARGV[1])
+    was_new = 1
+end
+redis.call('HDEL', KEYS[3], ARGV[2])
+local removed = redis.call('ZREM', KEYS[2], ARGV[2])
+local seq = 0
+if removed > 0 then
+    seq = redis.call('INCR', KEYS[4])
+end
+return {was_new, removed, seq}
+""")
+
+# 期限切れの in-flight を最大 ARGV[2] 件 queue に戻し、{戻した record の一覧, seq} を返す。
+# ※ ZRANGEBYSCORE はdeprecated扱いだが、Lua内では ZRANGE BYSCORE 非対応の古いRedisでも動くこちらを使う。
+# KEYS[1]=inflight, KEYS[2]=queue, KEYS[3]=inflight record, KEYS[4]=version, ARGV[1]=now, ARGV[2]=最大件数
+_requeue_lua = r.register_script("""
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #ids > 0 then
+    local records = redis.call('HMGET', KEYS[3], unpack(ids))
+    redis.call('ZREM', KEYS[1], unpack(ids))
+    redis.call('HDEL', KEYS[3], unpack(ids))
+    local out = {}
+    for i, record in ipairs(records) do
+        if record then
+            redis.call('LPUSH', KEYS[2], record)
+            table.insert(out, record)
+        end
+    end
+    return {out, redis.call('INCR', KEYS[4])}
+end
+return {{}, 0}
+""")
 
-r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 app = FastAPI(
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     root_path=ROOT_PATH
 )
 
@@ -93,165 +273,175 @@ class ResultIn(BaseModel):
     job_id: str
     result: Dict[str, Any]
 
-def payload_key(job_id: str) -> str:
-    return f"{PAYLOAD_KEY_PREFIX}{job_id}"
-
 def result_key(job_id: str) -> str:
     return f"{RESULT_KEY_PREFIX}{job_id}"
 
+def encode_json(obj: Any) -> bytes:
+    """
+    受け取った payload / result を保存用に JSON 化する。
+    orjson は64bitを超える整数などを扱えないので、その場合は 422 を返す。
+    """
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError as e:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY, f"cannot encode as JSON: {e}")
+
+def decode_records(records: list) -> list:
+    jobs = []
+    for record in records:
+        try:
+            jobs.append(orjson.loads(record))
+        except orjson.JSONDecodeError:
+            pass
+    return jobs
+
+async def fetch_jobs() -> Tuple[list, list, int]:
+    """
+    queue / inflight の job 一覧（{"job_id", "payload"}）と、その時点の seq を返す。
+    record をそのまま持っているので、job 数によらず往復1回。
+    MULTI で読むので、一覧と seq は同じ時点のものになる。
+    inflight は期限の早い順に並べる。
+    """
+    pipe = r.pipeline(transaction=True)
+    pipe.lrange(QUEUE_KEY, 0, -1)
+    pipe.zrange(INFLIGHT_KEY, 0, -1)
+    pipe.hgetall(INFLIGHT_RECORD_KEY)
+    pipe.get(VERSION_KEY)
+    queue_records, inflight_ids, inflight_records, seq = await pipe.execute()
+    return decode_records(queue_records), decode_records(
+        [inflight_records[job_id] for job_id in inflight_ids if job_id in inflight_records]
+    ), int(seq or 0)
+
 def get_queue_state() -> dict:
     """Get current queue state"""
-    queue_length = r.llen(QUEUE_KEY)
-    inflight_count = r.zcard(INFLIGHT_KEY)
     return {
-        "queue_length": queue_length,
-        "inflight_count": inflight_count
+        "queue_length": counts.queue_length,
+        "inflight_count": counts.inflight_count
     }
 
-async def broadcast_queue_update():
-    """Broadcast queue state update to all connected clients"""
+async def build_full_state() -> dict:
+    """Build combined queue metrics + job details message"""
     state = get_queue_state()
-    await manager.broadcast({
-        "type": "queue_update",
+    queue_jobs, inflight_jobs, seq = await fetch_jobs()
+    return {
+        "type": "state",
+        "seq": seq,
         "queue_length": state["queue_length"],
-        "inflight_count": state["inflight_count"]
-    })
-
-async def broadcast_job_update():
-    """Broadcast job details update to all connected clients"""
-    queue_jobs = []
-    inflight_jobs = []
-    
-    # Get queue job IDs
-    queue_job_ids = r.lrange(QUEUE_KEY, 0, -1)
-    for job_id in queue_job_ids:
-        payload_json = r.get(payload_key(job_id))
-        if payload_json:
-            try:
-                payload = json.loads(payload_json)
-                queue_jobs.append({"job_id": job_id, "payload": payload})
-            except json.JSONDecodeError:
-                pass
-    
-    # Get inflight job IDs
-    inflight_job_ids = r.zrange(INFLIGHT_KEY, 0, -1)
-    for job_id in inflight_job_ids:
-        payload_json = r.get(payload_key(job_id))
-        if payload_json:
-            try:
-                payload = json.loads(payload_json)
-                inflight_jobs.append({"job_id": job_id, "payload": payload})
-            except json.JSONDecodeError:
-                pass
-    
-    await manager.broadcast({
-        "type": "job_update",
+        "inflight_count": state["inflight_count"],
         "queue_jobs": queue_jobs,
         "inflight_jobs": inflight_jobs
+    }
+
+async def broadcast_delta(message_type: str, seq: int, **fields):
+    """
+    job の状態変化（差分）を配信する。現在の件数も添える。
+    全件のスナップショットは接続時にだけ送る。
+    seq は変更系スクリプトが返した値。配信順が前後してもクライアントは seq で並びを判断する。
+    """
+    await manager.broadcast({
+        "type": message_type,
+        "seq": seq,
+        **fields,
+        **get_queue_state()
     })
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+    async def initial_messages():
+        # Initial state (queue metrics + job details) and recent results
+        return [
+            await build_full_state(),
+            {"type": "results", "results": list(manager.recent_results)}
+        ]
+
+    await manager.connect(websocket, initial_messages)
     try:
-        # Send initial state
-        state = get_queue_state()
-        await websocket.send_json({
-            "type": "queue_update",
-            "queue_length": state["queue_length"],
-            "inflight_count": state["inflight_count"]
-        })
-        # Send initial job details
-        queue_jobs = []
-        inflight_jobs = []
-        
-        queue_job_ids = r.lrange(QUEUE_KEY, 0, -1)
-        for job_id in queue_job_ids:
-            payload_json = r.get(payload_key(job_id))
-            if payload_json:
-                try:
-                    payload = json.loads(payload_json)
-                    queue_jobs.append({"job_id": job_id, "payload": payload})
-                except json.JSONDecodeError:
-                    pass
-        
-        inflight_job_ids = r.zrange(INFLIGHT_KEY, 0, -1)
-        for job_id in inflight_job_ids:
-            payload_json = r.get(payload_key(job_id))
-            if payload_json:
-                try:
-                    payload = json.loads(payload_json)
-                    inflight_jobs.append({"job_id": job_id, "payload": payload})
-                except json.JSONDecodeError:
-                    pass
-        
-        await websocket.send_json({
-            "type": "job_update",
-            "queue_jobs": queue_jobs,
-            "inflight_jobs": inflight_jobs
-        })
-        # Send recent results
-        for result in manager.recent_results:
-            await websocket.send_json({
-                "type": "result",
-                **result
-            })
         # Keep connection alive
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
+async def push_jobs(payloads: List[Dict[str, Any]]):
+    """採番・record 化・LPUSH を1往復で行い、件数を更新して差分を配信する"""
+    if not payloads:
+        return
+    last, seq = await _enqueue_lua(
+        keys=[QUEUE_KEY, JOB_SEQ_KEY, VERSION_KEY],
+        args=[encode_json(p) for p in payloads],
+    )
+    counts.move(queue=len(payloads))
+    first = last - len(payloads)
+    await broadcast_delta("jobs_added", seq, jobs=[
+        {"job_id": str(first + i), "payload": payload}
+        for i, payload in enumerate(payloads, 1)
+    ])
+
 @app.post("/seed", status_code=204)
 async def seed(n: int = 5):
     """
     ダミーjobを n 件投入。
-    payload は JSON で保存。
+    payload は record(JSON) としてキューに直接積む。
     """
-    pipe = r.pipeline()
-    for i in range(n):
-        job_id = str(uuid.uuid4())
-        payload = {"type": "dummy", "i": i, "msg": "hello"}
-        pipe.set(payload_key(job_id), json.dumps(payload))
-        pipe.lpush(QUEUE_KEY, job_id)
-    pipe.execute()
-    await broadcast_queue_update()
-    await broadcast_job_update()
+    await push_jobs([{"type": "dummy", "i": i, "msg": "hello"} for i in range(n)])
     return Response(status_code=204)  # 204はボディなし :contentReference[oaicite:2]{index=2}
 
 @app.post("/enqueue", status_code=204)
 async def enqueue(payload: dict = Body(...)):
-    job_id = str(uuid.uuid4())
-    r.set(payload_key(job_id), json.dumps(payload))
-    r.lpush(QUEUE_KEY, job_id)
-    await broadcast_queue_update()
-    await broadcast_job_update()
+    await push_jobs([payload])
+    return Response(status_code=204)
+
+@app.post("/enqueue_bulk", status_code=204)
+async def enqueue_bulk(payloads: List[Dict[str, Any]] = Body(...)):
+    """
+    複数の payload をまとめて投入。
+    全 job を 1 回の _enqueue_lua 呼び出しで積む。
+    """
+    await push_jobs(payloads)
     return Response(status_code=204)
 
+async def pop_jobs(n: int) -> List[JobOut]:
+    """
+    最大 n 件取り出して in-flight に登録し、その一覧を返す。
+    worker は順に処理するので、i 件目(0始まり)の期限は now+LEASE_SEC*(i+1) と後ろほど延ばす。
+    """
+    now = int(time.time())
+    # RPOP + ZADD/HSET(in-flight登録) を n 件分まとめて1往復で
+    dropped, records, seq = await _pop_jobs_lua(
+        keys=[QUEUE_KEY, INFLIGHT_KEY, INFLIGHT_RECORD_KEY, DEAD_LETTER_KEY, VERSION_KEY],
+        args=[now, n, LEASE_SEC],
+    )
+    if dropped:
+        print(f"pop_jobs: moved {dropped} malformed record(s) to {DEAD_LETTER_KEY}")
+    started = [orjson.loads(record) for record in records]
+    counts.move(queue=-(len(started) + dropped), inflight=len(started))
+    if started:
+        await broadcast_delta("jobs_started", seq, jobs=started)
+    return [JobOut(lease_sec=LEASE_SEC * i, **job) for i, job in enumerate(started, 1)]
+
 @app.get("/job", response_model=Optional[JobOut])
 async def get_job():
     """
     1件取り出して in-flight に登録(期限=now+10s)して返す。
     キューが空なら 204。
     """
-    job_id = r.rpop(QUEUE_KEY)
-    if job_id is None:
+    jobs = await pop_jobs(1)
+    if not jobs:
         return Response(status_code=204)  # 204はボディなし :contentReference[oaicite:3]{index=3}
 
-    payload_json = r.get(payload_key(job_id))
-    if payload_json is None:
-        # 不整合（payloadが無い）: とりあえず捨てる or エラー
-        raise HTTPException(500, "payload missing")
+    return jobs[0]
 
-    deadline = int(time.time()) + LEASE_SEC
-    # in-flight登録
-    r.zadd(INFLIGHT_KEY, {job_id: deadline})
-    payload = json.loads(payload_json)
-    
-    await broadcast_queue_update()
-    await broadcast_job_update()
-
-    return JobOut(job_id=job_id, payload=payload, lease_sec=LEASE_SEC)
+@app.get("/jobs", response_model=List[JobOut])
+async def get_jobs(n: int = 16):
+    """
+    最大 n 件まとめて取り出して in-flight に登録して返す。
+    キューが空なら 204。
+    """
+    n = max(1, min(n, MAX_JOBS_PER_REQUEST))
+    jobs = await pop_jobs(n)
+    if not jobs:
+        return Response(status_code=204)
+    return jobs
 
 @app.post("/result", status_code=204)
 async def post_result(x: ResultIn):
@@ -259,41 +449,82 @@ async def post_result(x: ResultIn):
     結果を保存し、in-flight から削除。
     （冪等：すでに結果がある場合は上書きしない例）
     """
+    # 存在確認・保存・in-flight削除を1往復でアトミックに
+    was_new, removed, seq = await _post_result_lua(
+        keys=[result_key(x.job_id), INFLIGHT_KEY, INFLIGHT_RECORD_KEY, VERSION_KEY],
+        args=[encode_json(x.result), x.job_id],
+    )
+    counts.move(inflight=-removed)
+    if removed:
+        await broadcast_delta("jobs_completed", seq, job_ids=[x.job_id])
     # すでに結果があるなら何もしない（重複報告対策）
-    if r.exists(result_key(x.job_id)):
-        r.zrem(INFLIGHT_KEY, x.job_id)
-        await broadcast_queue_update()
-        await broadcast_job_update()
+    if not was_new:
         return Response(status_code=204)
 
     print(f"result: {x.result}")
-    pipe = r.pipeline()
-    pipe.set(result_key(x.job_id), json.dumps(x.result))
-    pipe.zrem(INFLIGHT_KEY, x.job_id)
-    pipe.execute()
-    
+
     # Add to recent results and broadcast
     manager.add_result(x.job_id, x.result)
     await manager.broadcast({
         "type": "result",
-        "job_id": x.job_id,
-        "result": x.result,
-        "timestamp": int(time.time())
+        **manager.recent_results[-1]
     })
-    await broadcast_queue_update()
-    await broadcast_job_update()
-    
+
+    return Response(status_code=204)
+
+@app.post("/result_bulk", status_code=204)
+async def post_result_bulk(items: List[ResultIn]):
+    """
+    複数の結果をまとめて保存。
+    各 job の _post_result_lua を1つの pipeline で流し、往復を1回にする。
+    新しい結果は1通の results メッセージでまとめて配信する。
+    """
+    pipe = r.pipeline(transaction=False)
+    for x in items:
+        await _post_result_lua(
+            keys=[result_key(x.job_id), INFLIGHT_KEY, INFLIGHT_RECORD_KEY, VERSION_KEY],
+            args=[encode_json(x.result), x.job_id],
+            client=pipe,
+        )
+    replies = await pipe.execute()
+
+    new_results = []
+    completed = []
+    last_seq = 0
+    for x, (was_new, removed, seq) in zip(items, replies):
+        counts.move(inflight=-removed)
+        if removed:
+            completed.append(x.job_id)
+            last_seq = max(last_seq, seq)
+        # すでに結果があるものは捨てる（重複報告対策）
+        if not was_new:
+            continue
+        print(f"result: {x.result}")
+        manager.add_result(x.job_id, x.result)
+        new_results.append(manager.recent_results[-1])
+
+    # pipeline 中の各 job の seq は他の変更と入り混じるが、完了した job は queue にも
+    # in-flight にも居ないので後から変更されることはない。まとめて最大の seq を付ける。
+    if completed:
+        await broadcast_delta("jobs_completed", last_seq, job_ids=completed)
+    if new_results:
+        await manager.broadcast({
+            "type": "results",
+            "results": new_results
+        })
+
     return Response(status_code=204)
 
 @app.get("/result/{job_id}")
-def get_result(job_id: str):
-    v = r.get(result_key(job_id))
+async def get_result(job_id: str):
+    v = await r.get(result_key(job_id))
     if v is None:
         raise HTTPException(404, "no result")
-    return json.loads(v)
+    # 保存済みの JSON をそのまま返す（decode/encode しない）
+    return Response(content=v, media_type="application/json")
 
 @app.get("/queue/status")
-def get_queue_status():
+async def get_queue_status():
     """Get current queue state and recent results"""
     state = get_queue_state()
     return {
@@ -303,33 +534,9 @@ def get_queue_status():
     }
 
 @app.get("/queue/jobs")
-def get_queue_jobs():
+async def get_queue_jobs():
     """Get current queue and inflight job details"""
-    queue_jobs = []
-    inflight_jobs = []
-    
-    # Get queue job IDs
-    queue_job_ids = r.lrange(QUEUE_KEY, 0, -1)
-    for job_id in queue_job_ids:
-        payload_json = r.get(payload_key(job_id))
-        if payload_json:
-            try:
-                payload = json.loads(payload_json)
-                queue_jobs.append({"job_id": job_id, "payload": payload})
-            except json.JSONDecodeError:
-                pass
-    
-    # Get inflight job IDs
-    inflight_job_ids = r.zrange(INFLIGHT_KEY, 0, -1)
-    for job_id in inflight_job_ids:
-        payload_json = r.get(payload_key(job_id))
-        if payload_json:
-            try:
-                payload = json.loads(payload_json)
-                inflight_jobs.append({"job_id": job_id, "payload": payload})
-            except json.JSONDecodeError:
-                pass
-    
+    queue_jobs, inflight_jobs, _ = await fetch_jobs()
     return {
         "queue_jobs": queue_jobs,
         "inflight_jobs": inflight_jobs
@@ -337,29 +544,30 @@ def get_queue_jobs():
 
 @app.post("/queue/clear", status_code=204)
 async def clear_queue():
-    """Clear all queue data: queue, inflight, payloads, and results"""
+    """Clear all queue data: queue, inflight, and results"""
     # Get all job IDs from queue and inflight
-    queue_job_ids = r.lrange(QUEUE_KEY, 0, -1)
-    inflight_job_ids = r.zrange(INFLIGHT_KEY, 0, -1)
-    all_job_ids = set(queue_job_ids + inflight_job_ids)
-    
-    # Delete all payloads and results
-    pipe = r.pipeline()
-    for job_id in all_job_ids:
-        pipe.delete(payload_key(job_id))
-        pipe.delete(result_key(job_id))
-    pipe.execute()
-    
-    # Clear queue and inflight
-    r.delete(QUEUE_KEY)
-    r.delete(INFLIGHT_KEY)
-    
-    # Clear recent results in memory
+    queue_jobs, inflight_jobs, _ = await fetch_jobs()
+    all_job_ids = set(job["job_id"] for job in queue_jobs + inflight_jobs)
+
+    # Delete queue, inflight and all results (DEL は可変長引数なので1回で)
+    # 差分と同じく seq を進めて、clear 前の差分がクライアントで読み飛ばされるようにする
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(
+        QUEUE_KEY,
+        INFLIGHT_KEY,
+        INFLIGHT_RECORD_KEY,
+        DEAD_LETTER_KEY,
+        *(result_key(job_id) for job_id in all_job_ids),
+    )
+    pipe.incr(VERSION_KEY)
+    await pipe.execute()
+
+    # Clear recent results and counters in memory
     manager.recent_results.clear()
-    
-    # Broadcast updates
-    await broadcast_queue_update()
-    await broadcast_job_update()
+    counts.reset()
+
+    # Broadcast full (empty) state
+    await manager.broadcast(await build_full_state())
     
     return Response(status_code=204)
 
@@ -368,10 +576,10 @@ def ping():
     return "pong"
 
 @app.get("/healthz")
-def healthz():
+async def healthz():
     try:
         # Redis 疎通確認（最小・高速）
-        r.ping()
+        await r.ping()
         return {
             "status": "ok",
             "redis": "ok",
@@ -387,20 +595,28 @@ def healthz():
 async def requeue_loop():
     """
     in-flight の期限切れを queue に戻す。
-    ※ ZRANGEBYSCORE はdeprecated扱いなので、ZRANGE BYSCORE を使うのが推奨。:contentReference[oaicite:4]{index=4}
-    redis-py では zrange(..., byscore=True, ...) で呼べる。
+    回収（ZRANGE BYSCORE + ZREM + LPUSH）は _requeue_lua で1往復・アトミックに行う。
+    固定周期でスキャンせず、最も早い期限まで眠ってから回収する。
     """
     while True:
-        now = int(time.time())
+        # 最も期限の近い1件（プロセス内の件数は Redis とずれ得るので、判定は必ず Redis で行う）
+        head = await r.zrange(INFLIGHT_KEY, 0, 0, withscores=True)
+        if not head:
+            await asyncio.sleep(REQUEUE_PERIOD_SEC)
+            continue
+        _, deadline = head[0]
+        delay = deadline - time.time()
+        if delay > 0:
+            # 期限まで待つ（後から来た lease の方が期限が早いこともあるので上限を置く）
+            await asyncio.sleep(min(delay, REQUEUE_PERIOD_SEC))
+            continue
 
         # 期限切れを最大100件ずつ回収
-        expired = r.zrange(INFLIGHT_KEY, "-inf", now, byscore=True, start=0, num=100)
-        if expired:
-            pipe = r.pipeline()
-            for job_id in expired:
-                pipe.zrem(INFLIGHT_KEY, job_id)
-                pipe.lpush(QUEUE_KEY, job_id)
-            pipe.execute()
-            await broadcast_job_update()
-
-        await asyncio.sleep(REQUEUE_PERIOD_SEC)
+        now = int(time.time())
+        requeued, seq = await _requeue_lua(
+            keys=[INFLIGHT_KEY, QUEUE_KEY, INFLIGHT_RECORD_KEY, VERSION_KEY],
+            args=[now, 100],
+        )
+        if requeued:
+            counts.move(queue=len(requeued), inflight=-len(requeued))
+            await broadcast_delta("jobs_requeued", seq, jobs=[orjson.loads(record) for record in requeued])
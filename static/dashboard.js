@@ -20,6 +20,14 @@ class Dashboard {
             piDecimal: document.getElementById('piDecimal')
         };
 
+        // Job state (rebuilt from 'state' snapshots, updated by jobs_* deltas)
+        this.queueJobs = new Map(); // Map<job_id, payload>
+        this.inflightJobs = new Map(); // Map<job_id, payload>
+        // 差分は seq 順に届くとは限らないので、job ごとに反映済みの seq を持つ（完了した job も残す）
+        this.jobSeqs = new Map(); // Map<job_id, seq>
+        this.baseSeq = 0; // 最新スナップショットの seq（これ以下の差分は反映済み）
+        this.metricsSeq = 0; // 件数表示に反映した seq
+
         // Pi digit state management
         this.digitStates = new Map(); // Map<digitIndex, {state: 'queue'|'inflight'|'result', value: string}>
         this.maxDigit = -1;
@@ -128,25 +136,57 @@ class Dashboard {
 
     handleMessage(data) {
         switch (data.type) {
-            case 'queue_update':
-                this.updateQueueMetrics(data.queue_length, data.inflight_count);
+            case 'state':
+                this.applySnapshot(data);
+                this.applyMetrics(data);
+                this.refreshJobStates();
+                break;
+            case 'jobs_added':
+                for (const job of data.jobs) {
+                    this.moveJob(job.job_id, data.seq, 'queue', job.payload);
+                }
+                this.applyMetrics(data);
+                this.refreshJobStates();
+                break;
+            case 'jobs_started':
+                for (const job of data.jobs) {
+                    this.moveJob(job.job_id, data.seq, 'inflight', job.payload);
+                }
+                this.applyMetrics(data);
+                this.refreshJobStates();
+                break;
+            case 'jobs_completed':
+                for (const jobId of data.job_ids) {
+                    this.moveJob(jobId, data.seq, 'done');
+                }
+                this.applyMetrics(data);
+                this.refreshJobStates();
                 break;
-            case 'job_update':
-                this.updateJobStates(data.queue_jobs, data.inflight_jobs);
-                // renderPiDigits()内でrenderPiDecimal()が呼ばれる
+            case 'jobs_requeued':
+                for (const job of data.jobs) {
+                    this.moveJob(job.job_id, data.seq, 'queue', job.payload);
+                }
+                this.applyMetrics(data);
+                this.refreshJobStates();
                 break;
             case 'result':
                 this.addResult(data);
                 // addResult() → updateResultState() → renderPiDigits() → renderPiDecimal()が呼ばれる
                 break;
+            case 'results':
+                // /result_bulk でまとめて届いた結果
+                for (const result of data.results) {
+                    this.addResult(result);
+                }
+                break;
             default:
                 console.warn('Unknown message type:', data.type);
         }
 
         // リロード時：初期状態の処理後に10進数計算を確実に実行
         // resultメッセージ以外の場合のみ、タイムアウトで確実に実行
-        // (resultメッセージの場合は既にrenderPiDecimal()が呼ばれている)
-        if (data.type !== 'result' && this.ws && this.ws.readyState === WebSocket.OPEN) {
+        // (result/resultsメッセージの場合は既にrenderPiDecimal()が呼ばれている)
+        if (data.type !== 'result' && data.type !== 'results' && this.ws && this.ws.readyState === WebSocket.OPEN) {
             clearTimeout(this.initialRenderTimeout);
             this.initialRenderTimeout = setTimeout(() => {
                 if (this.maxDigit >= 0 || this.digitStates.size > 0) {
@@ -156,12 +196,67 @@ class Dashboard {
         }
     }
 
+    // job を target（'queue' | 'inflight' | 'done'）へ移す。
+    // その job について反映済みの差分より古い seq なら何もしない（配信順は Redis の実行順と前後し得る）
+    moveJob(jobId, seq, target, payload) {
+        if (seq <= this.baseSeq || (this.jobSeqs.get(jobId) ?? 0) >= seq) {
+            return;
+        }
+        this.jobSeqs.set(jobId, seq);
+        this.queueJobs.delete(jobId);
+        this.inflightJobs.delete(jobId);
+        if (target === 'queue') {
+            this.queueJobs.set(jobId, payload);
+        } else if (target === 'inflight') {
+            this.inflightJobs.set(jobId, payload);
+        }
+    }
+
+    // スナップショット（data.seq 時点）で置き換える。
+    // ただし先に届いていた、より新しい差分で動いた job はそちらを優先する。
+    applySnapshot(data) {
+        const prevSeqs = this.jobSeqs;
+        const prevQueue = this.queueJobs;
+        const prevInflight = this.inflightJobs;
+
+        this.jobSeqs = new Map();
+        this.queueJobs = new Map(data.queue_jobs.map(job => [job.job_id, job.payload]));
+        this.inflightJobs = new Map(data.inflight_jobs.map(job => [job.job_id, job.payload]));
+        this.baseSeq = Math.max(this.baseSeq, data.seq);
+
+        for (const [jobId, seq] of prevSeqs) {
+            if (seq <= data.seq) {
+                continue;
+            }
+            if (prevQueue.has(jobId)) {
+                this.moveJob(jobId, seq, 'queue', prevQueue.get(jobId));
+            } else if (prevInflight.has(jobId)) {
+                this.moveJob(jobId, seq, 'inflight', prevInflight.get(jobId));
+            } else {
+                this.moveJob(jobId, seq, 'done');
+            }
+        }
+    }
+
+    applyMetrics(data) {
+        if (data.seq < this.metricsSeq) {
+            return;
+        }
+        this.metricsSeq = data.seq;
+        this.updateQueueMetrics(data.queue_length, data.inflight_count);
+    }
+
     updateQueueMetrics(queueLength, inflightCount) {
         this.elements.queueLength.textContent = queueLength;
         this.elements.inflightCount.textContent = inflightCount;
     }
 
     addResult(data) {
+        // 接続直後はスナップショットと差分で同じ結果が2回届くことがある（job_id は再利用されない）
+        if (this.results.some(result => result.job_id === data.job_id)) {
+            return;
+        }
+
         // Add to beginning of array
         this.results.unshift({
             job_id: data.job_id,
@@ -313,6 +408,11 @@ class Dashboard {
         return hexString;
     }
 
+    refreshJobStates() {
+        const toList = (jobs) => Array.from(jobs, ([job_id, payload]) => ({ job_id, payload }));
+        this.updateJobStates(toList(this.queueJobs), toList(this.inflightJobs));
+    }
+
     updateJobStates(queueJobs, inflightJobs) {
         // Track which digits are in queue or inflight
         const queueDigits = new Set();
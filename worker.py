@@ -1,74 +1,119 @@
+import os
 import time
 import math
+import sys
+import signal
+import argparse
+import multiprocessing
+import multiprocessing.connection
 import requests
-from decimal import Decimal, getcontext
+
+try:
+    # numba があれば BBP の計算部分を JIT コンパイルする（無ければ素の Python で動く）
+    from numba import njit
+except ImportError:
+    njit = None
 
 BASE = "http://localhost:8099"
-S = requests.Session()
+JOBS_PER_REQUEST = 16  # /jobs で一度に受け取る job 数
+RESULTS_PER_POST = 16  # /result_bulk で一度に送る結果数の上限
+RESULT_FLUSH_SEC = 0.5  # 結果を手元に溜めておく最長時間
+
+_jit = njit(cache=True) if njit is not None else (lambda f: f)
 
-# Decimal は標準ライブラリ。尾部の無限和を安定にするために少しだけ使う。
-getcontext().prec = 80
+# numba では int64 で剰余を取るので、(8n+6)^2 が 2^63 未満に収まる桁までしか正しく計算できない。
+# 素の Python は多倍長整数なので上限なし。
+MAX_DIGIT_END = (3_037_000_499 - 6) // 8 + 1 if njit is not None else None  # start+count の上限
 
+@_jit
 def _frac(x: float) -> float:
     # x の小数部分（正に正規化）
     return x - math.floor(x)
 
-def _powmod16(exp: int, mod: int) -> int:
-    # 16^exp mod mod
-    return pow(16, exp, mod)
-
-def _bbp_S(j: int, n: int) -> float:
+if njit is not None:
+    @_jit
+    def _powmod16(exp: int, mod: int) -> int:
+        # 16^exp mod mod（二分累乗法。int64 なので mod^2 < 2^63、つまり MAX_DIGIT_END まで）
+        result = 1 % mod
+        base = 16 % mod
+        while exp > 0:
+            if exp & 1:
+                result = (result * base) % mod
+            base = (base * base) % mod
+            exp >>= 1
+        return result
+else:
+    def _powmod16(exp: int, mod: int) -> int:
+        # 16^exp mod mod
+        return pow(16, exp, mod)
+
+@_jit
+def _bbp_S_range(j: int, start: int, count: int):
     """
     S_j(n) = sum_{k=0..n} 16^(n-k) mod (8k+j) / (8k+j)
            + sum_{k=n+1..∞} 16^(n-k) / (8k+j)
-    ここで返すのは小数部分（厳密に整数部は不要）なので、途中で frac を取って暴走を防ぐ。
+    の小数部分を n = start..start+count-1 についてまとめて計算する。
+    途中で frac を取って暴走を防ぐ。
+    16^(n+1-k) mod ak = 16 * (16^(n-k) mod ak) mod ak なので、
+    k ごとに累乗剰余は1回だけ求め、後続の桁は16倍していくだけで済む。
     """
-    # 前半（mod で厳密に）
-    s = 0.0
-    for k in range(n + 1):
+    s = [0.0] * count
+    # 前半（mod で厳密に）。各桁とも k の昇順に足す。
+    for k in range(start + count):
         ak = 8 * k + j
-        r = _powmod16(n - k, ak)
-        s = _frac(s + r / ak)
+        if k <= start:
+            i0 = 0
+            r = _powmod16(start - k, ak)
+        else:
+            # 桁 k-start から寄与し始める（指数0）
+            i0 = k - start
+            r = 1 % ak
+        for i in range(i0, count):
+            s[i] = _frac(s[i] + r / ak)
+            r = (r * 16) % ak
 
+    for i in range(count):
+        s[i] = _bbp_tail(j, start + i, s[i])
+    return s
+
+@_jit
+def _bbp_tail(j: int, n: int, s: float) -> float:
+    """S_j(n) の後半 sum_{k=n+1..∞} 16^(n-k) / (8k+j) を s に足した小数部分を返す"""
     # 後半（急速に減衰。必要項数だけ）
-    # exp = n-k が負なので 16^(n-k) は 16^(-t) で急減。
-    # 20～30項程度で十分になることが多い。nが大きい場合も尾部は同様に収束。
+    # exp = n-k = -t が負なので 16^(n-k) は 16^(-t) で急減。
+    # 15項程度で double の精度を下回るので、float のままで十分。
     t = 1
-    while True:
+    while t <= 1000:  # 異常時の安全弁
         k = n + t
         ak = 8 * k + j
-        term = (Decimal(16) ** Decimal(n - k)) / Decimal(ak)  # 16^(n-k)/ak
-        term_f = float(term)
+        term_f = 16.0 ** (n - k) / ak  # 16^(n-k)/ak
         if term_f < 1e-17:  # double 精度の下限目安
             break
         s = _frac(s + term_f)
         t += 1
-        if t > 1000:  # 異常時の安全弁
-            break
 
     return s
 
-def pi_hex_digit(n: int) -> int:
+@_jit
+def pi_hex_range_core(start: int, count: int):
     """
-    π の16進小数点以下 n 桁目（0始まり）を返す（0..15）。
+    π の16進小数点以下 start..start+count-1 桁目をまとめて返す（各 0..15）。
     digit = floor(16 * frac( 4*S1 - 2*S4 - S5 - S6 ))
     """
-    s1 = _bbp_S(1, n)
-    s4 = _bbp_S(4, n)
-    s5 = _bbp_S(5, n)
-    s6 = _bbp_S(6, n)
+    s1 = _bbp_S_range(1, start, count)
+    s4 = _bbp_S_range(4, start, count)
+    s5 = _bbp_S_range(5, start, count)
+    s6 = _bbp_S_range(6, start, count)
 
-    x = 4.0 * s1 - 2.0 * s4 - 1.0 * s5 - 1.0 * s6
-    x = _frac(x)
-    d = int(16.0 * x)
-    return d
+    digits = [0] * count
+    for i in range(count):
+        x = 4.0 * s1[i] - 2.0 * s4[i] - 1.0 * s5[i] - 1.0 * s6[i]
+        x = _frac(x)
+        digits[i] = int(16.0 * x)
+    return digits
 
 def pi_hex_range(start: int, count: int) -> str:
-    digits = []
-    for i in range(count):
-        d = pi_hex_digit(start + i)
-        digits.append("0123456789ABCDEF"[d])
-    return "".join(digits)
+    return "".join("0123456789ABCDEF"[d] for d in pi_hex_range_core(start, count))
 
 def do_job(payload: dict) -> dict:
     if payload.get("type") != "bbp_hex":
@@ -77,37 +122,114 @@ def do_job(payload: dict) -> dict:
     count = int(payload["count"])
     if start < 0 or count <= 0 or count > 512:
         raise ValueError("bad start/count (count<=64 recommended for demo)")
+    if MAX_DIGIT_END is not None and start + count > MAX_DIGIT_END:
+        # 黙って桁化けさせず、計算できない範囲として失敗させる
+        raise ValueError(f"start+count must be <= {MAX_DIGIT_END} with numba")
 
     hexstr = pi_hex_range(start, count)
     return {"hex": hexstr, "start": start, "count": count}
 
-def main():
+def run_one_worker():
+    # Session はプロセスごとに持つ（fork 元と接続を共有しない）
+    S = requests.Session()
+    results = []  # /result_bulk に送る前の結果
+    first_buffered = 0.0
+    first_deadline = 0.0  # 溜めている結果のうち最も早い lease 期限（monotonic）
+    last_elapsed = 0.0  # 直前の job の計算時間
+
+    def flush_results():
+        if not results:
+            return
+        try:
+            S.post(f"{BASE}/result_bulk", json=results, timeout=20).raise_for_status()
+        except Exception:
+            # 送れなかった job は lease 切れで再実行される
+            pass
+        results.clear()
+
     while True:
         # time.sleep(1.0)
 
-        r = S.get(f"{BASE}/job", timeout=10)
+        # 1往復で複数 job を受け取り、手元で順に処理する
+        r = S.get(f"{BASE}/jobs", params={"n": JOBS_PER_REQUEST}, timeout=10)
         if r.status_code == 204:
             time.sleep(1.0)
             continue
         r.raise_for_status()
-        job = r.json()
+        fetched = time.monotonic()
 
-        job_id = job["job_id"]
-        payload = job["payload"]
+        for job in r.json():
+            job_id = job["job_id"]
+            payload = job["payload"]
+
+            # 溜めるのは短い job だけ。直前の job が RESULT_FLUSH_SEC 以上かかった場合や、
+            # 次の job も同じだけかかると溜めている結果の lease が切れる場合は、計算前に送る。
+            if results and (last_elapsed >= RESULT_FLUSH_SEC
+                            or time.monotonic() + last_elapsed >= first_deadline):
+                flush_results()
 
-        try:
-            result = do_job(payload)
-            S.post(f"{BASE}/result",
-                   json={"job_id": job_id, "result": result},
-                   timeout=20).raise_for_status()
-        except Exception as e:
-            # 既存の /fail がある前提（なければ /result にエラー格納でもOK）
             try:
-                S.post(f"{BASE}/fail",
-                       json={"job_id": job_id, "error": repr(e)},
-                       timeout=10)
-            except Exception:
-                pass
+                started = time.monotonic()
+                result = do_job(payload)
+                last_elapsed = time.monotonic() - started
+                if not results:
+                    first_buffered = time.monotonic()
+                    first_deadline = fetched + job["lease_sec"]
+                results.append({"job_id": job_id, "result": result})
+                # 件数か経過時間が閾値を超えたらまとめて送る
+                if (len(results) >= RESULTS_PER_POST
+                        or time.monotonic() - first_buffered >= RESULT_FLUSH_SEC):
+                    flush_results()
+            except Exception as e:
+                # 既存の /fail がある前提（なければ /result にエラー格納でもOK）
+                try:
+                    S.post(f"{BASE}/fail",
+                           json={"job_id": job_id, "error": repr(e)},
+                           timeout=10)
+                except Exception:
+                    pass
+
+        # 次の取得前に残りを送る（lease 切れを避けるため溜め込まない）
+        flush_results()
+
+def _run_child_worker():
+    # 親の SIGTERM ハンドラを引き継がず、terminate() で素直に止まるようにする
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    run_one_worker()
+
+def main():
+    parser = argparse.ArgumentParser(description="π の16進桁を計算するワーカー")
+    parser.add_argument(
+        "--procs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="並列に動かすワーカープロセス数（デフォルト: CPUコア数）"
+    )
+    args = parser.parse_args()
+
+    if args.procs <= 1:
+        run_one_worker()
+        return
+
+    # BBP は CPU バウンドなので、GIL の影響を受けないようスレッドではなくプロセスで並列化
+    # kill(SIGTERM) でも下の finally で子を止めてから終了するよう、SystemExit に変換する
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+    procs = [multiprocessing.Process(target=_run_child_worker) for _ in range(args.procs)]
+    for p in procs:
+        p.start()
+    try:
+        # run_one_worker は戻らないので、どれか1つでも終了したら異常（例外のトレースバックは子が出力済み）
+        multiprocessing.connection.wait([p.sentinel for p in procs])
+    finally:
+        # 残りも止めて、1プロセスで動かした時と同じくワーカー全体として終了する
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            p.join()
+
+    exitcodes = [p.exitcode for p in procs if p.exitcode != -signal.SIGTERM]  # terminate() で止めた分は除く
+    sys.exit(f"worker process exited (exitcode={exitcodes})")
 
 if __name__ == "__main__":
     main()